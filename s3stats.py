@@ -12,19 +12,90 @@
 
 import re
 import sys
-import boto
 import json
 import time
+import boto3
+import sqlite3
 import logging
-from os import getenv, path
-from fnmatch import fnmatch
+from os import getenv, makedirs, path
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
+from string import digits, ascii_letters
+from itertools import compress, product, repeat
+from fnmatch import translate
 from functools import partial
-from hurry.filesize import size
 from argparse import ArgumentParser
 from prettytable import PrettyTable
-from collections import defaultdict
+from operator import eq, itemgetter
+from collections import Counter, defaultdict
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from multiprocessing.dummy import Pool as ThreadPool
 
+try:
+    import orjson
+except ImportError:
+    # orjson isn't available on PyPy
+    orjson = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+# The columns of the parquet S3 Inventory files used by InventoryStats()
+INVENTORY_COLUMNS = [ "key", "size", "last_modified_date", "storage_class",
+                      "encryption_status", "is_latest", "is_delete_marker" ]
+
+# The characters the key space is split on by ShardBoundaries(), in S3's
+# (UTF-8 binary) key order
+SHARD_CHARS = "".join(sorted(digits + ascii_letters))
+
+# The s3 client methods fetching the --bucket-details, by result field
+BUCKET_DETAILS = [ ("lifecycle", "get_bucket_lifecycle_configuration"),
+                   ("location" , "get_bucket_location"),
+                   ("logging"  , "get_bucket_logging"),
+                   ("tags"     , "get_bucket_tagging"),
+                   ("version"  , "get_bucket_versioning") ]
+
+# The storage classes of the StorageType dimension of the BucketSizeBytes
+# CloudWatch metric, other storage types are reported under their own name
+# except the *Overhead ones which are left out
+CLOUDWATCH_STORAGE_CLASSES = {
+    "StandardStorage"               : "STANDARD",
+    "StandardIAStorage"             : "STANDARD_IA",
+    "OneZoneIAStorage"              : "ONEZONE_IA",
+    "ReducedRedundancyStorage"      : "REDUCED_REDUNDANCY",
+    "IntelligentTieringFAStorage"   : "INTELLIGENT_TIERING",
+    "IntelligentTieringIAStorage"   : "INTELLIGENT_TIERING",
+    "IntelligentTieringAAStorage"   : "INTELLIGENT_TIERING",
+    "IntelligentTieringAIAStorage"  : "INTELLIGENT_TIERING",
+    "IntelligentTieringDAAStorage"  : "INTELLIGENT_TIERING",
+    "GlacierInstantRetrievalStorage": "GLACIER_IR",
+    "GlacierStorage"                : "GLACIER",
+    "DeepArchiveStorage"            : "DEEP_ARCHIVE",
+}
+
+# The maximum number of queries of a GetMetricData request
+CLOUDWATCH_MAX_QUERIES = 500
+
+# The command-line arguments changing the Stats() of a bucket, they are part of
+# the key of its cache entry
+CACHE_ARGS = [ "prefix", "filter", "filterRe", "sumPrevVersions",
+               "bucketDetails", "useInventory", "fromCloudWatch" ]
+
+# The unit suffixes of HumanSize(), one per power of 1024
+SIZE_UNITS = "BKMGTPE"
+
+# The Stats() result fields which may have a None key, json stores it as "null"
+CACHE_NONE_KEYS = [ "storageClasses", "encrypted", "lifecycle" ]
+
+# The name of the folder of an S3 Inventory delivery (YYYY-MM-DDTHH-MMZ/)
+INVENTORY_DELIVERY = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}-\d{2}Z/$")
+
 
 #############
 # Logging Utilities
@@ -62,12 +133,16 @@ class Logging(object):
 
     def GetLoggers(self):
         """Return a list of the logger methods: (debug, info, warn, error)."""
-        return self.log.debug, self.log.info, self.log.warn, self.log.error
+        return self.log.debug, self.log.info, self.log.warning, self.log.error
 
 
 def LogCalls(func):
     """Decorator to log function calls for debugging."""
     def wrapper(*args, **kargs):
+        # Don't pay for the repr() of the arguments unless they are logged
+        if not log.isEnabledFor(logging.DEBUG):
+            return func(*args, **kargs)
+
         callStr = "%s(%s)" % (func.__name__, ", ".join([repr(p) for p in args] + ["%s=%s" % (k, repr(v)) for (k, v) in list(kargs.items())]))
         debug(">> %s", callStr)
         ret = func(*args, **kargs)
@@ -82,67 +157,645 @@ def LogCalls(func):
 
 @LogCalls
 def LifecycleToDict(lc):
-    """Convert an s3 Lifecycle object to a dictionary.
+    """Convert an s3 lifecycle rule to a dictionary.
 
     Args:
-        lc (boto.s3.lifecycle.Lifecycle): The element to be converted to a dict.
+        lc (dict): The lifecycle rule, as returned by
+            get_bucket_lifecycle_configuration, to be converted to a dict.
 
     Returns:
-        dict: The dictionary representation of the lifecycle object.
+        dict: The dictionary representation of the lifecycle rule.
     """
-    return { "prefix"    : lc.prefix,
-             "status"    : lc.status,
-             "expiration": { "date": lc.expiration.date,
-                             "days": lc.expiration.days },
-             "transition": lc.transition }
+    expiration = lc.get("Expiration", {})
+    transitions = [ dict(t, Date = t["Date"].isoformat()) if "Date" in t else t
+                    for t in lc.get("Transitions", []) ]
+
+    return { "prefix"    : lc.get("Prefix", lc.get("Filter", {}).get("Prefix")),
+             "status"    : lc["Status"],
+             "expiration": { "date": expiration["Date"].isoformat() if "Date" in expiration else None,
+                             "days": expiration.get("Days") },
+             "transition": transitions }
 
 
 @LogCalls
 def LoggingStatusToDict(loggingStatus):
-    """Convert an s3 BucketLoging object to a dictionary.
+    """Convert an s3 bucket logging status to a dictionary.
 
     Args:
-        loggingStatus (boto.s3.bucketlogging.BucketLogging): The element to be
+        loggingStatus (dict): The response of get_bucket_logging to be
             converted to a dict.
 
     Returns:
-        dict: The dictionary representation of the logging object.
+        dict: The dictionary representation of the logging status.
     """
-    return { "target": loggingStatus.target,
-             "prefix": loggingStatus.prefix,
-             "grants": loggingStatus.grants }
+    loggingEnabled = loggingStatus.get("LoggingEnabled", {})
 
+    return { "target": loggingEnabled.get("TargetBucket"),
+             "prefix": loggingEnabled.get("TargetPrefix"),
+             "grants": loggingEnabled.get("TargetGrants", []) }
 
-@LogCalls
-def Lister(bucket, versions = False):
-    """Select an appropriate s3 bucket lister.
+
+def Lister(s3, versions = False):
+    """Select an appropriate s3 bucket paginator.
 
     Args:
-        bucket (boto.s3.bucket): The bucket for which a lister is requested.
+        s3 (botocore.client.S3): The s3 client to paginate with.
         versions (bool): True we want to list versions, False we don't.
 
     Returns:
-        Either of boto.s3.bucket.list_versions or boto.s3.bucket.list.
+        tuple: The list_object_versions or list_objects_v2 paginator and the
+            name of the field holding the keys in each of its pages.
+    """
+    if versions:
+        return s3.get_paginator("list_object_versions"), "Versions"
+
+    return s3.get_paginator("list_objects_v2"), "Contents"
+
+
+def TotalsToDict(counts, sizes):
+    """Convert flat numberOfFiles and sizeOfFiles totals to the Stats()
+    dictionaries.
+
+    Args:
+        counts (collections.Counter): The numberOfFiles, by name.
+        sizes (collections.Counter): The sizeOfFiles, by name.
+
+    Returns:
+        dict: The {"numberOfFiles": ..., "sizeOfFiles": ...} dictionaries,
+            by name.
+    """
+    stats = defaultdict(lambda: defaultdict(int))
+    for name, numberOfFiles in counts.items():
+        stats[name]["numberOfFiles"] = numberOfFiles
+        stats[name]["sizeOfFiles"] = sizes[name]
+
+    return stats
+
+
+@LogCalls
+def ListingStats(s3, bucketName, args, keyMatcher = None, keyRange = (None, None)):
+    """Calculate the key statistics of a bucket by listing its keys.
+
+    Args:
+        s3 (botocore.client.S3): The s3 client to issue requests with.
+        bucketName (string): The name of the bucket to list.
+        args (dict): The result of command-line arguments parsing.
+        keyMatcher (callable): The Matcher() keys must satisfy to be counted,
+            None to count every key.
+        keyRange (tuple): Only list the keys greater than the first item and
+            lower or equal to the second one, None for an open end.
+
+    Returns:
+        dict: The numberOfFiles, sizeOfFiles, modifiedDate, storageClasses
+            and encrypted statistics of the bucket.
+    """
+    numberOfFiles = 0
+    sizeOfFiles = 0
+    # In seconds since the epoch, 0 until a key is counted
+    lastModified = 0
+    classCounts = Counter()
+    classSizes = Counter()
+
+    getSize = itemgetter("Size")
+    getStorageClass = itemgetter("StorageClass")
+    getLastModified = itemgetter("LastModified")
+
+    startAfter, stopAt = keyRange
+    markers = {}
+    if startAfter is not None:
+        markers["KeyMarker" if args.sumPrevVersions else "StartAfter"] = startAfter
+
+    paginator, field = Lister(s3, args.sumPrevVersions)
+    pages = paginator.paginate(Bucket = bucketName,
+                               Prefix = args.prefix,
+                               PaginationConfig = { "PageSize": 1000 },
+                               **markers)
+
+    for page in pages:
+        keys = page.get(field, [])
+
+        # Keys are listed in order, the range is over past the stop key
+        rangeDone = stopAt is not None and len(keys) > 0 and keys[-1]["Key"] > stopAt
+        if rangeDone:
+            keys = [ k for k in keys if k["Key"] <= stopAt ]
+
+        if keyMatcher is not None:
+            keys = [ k for k in keys if keyMatcher(k["Key"]) is not None ]
+
+        # Aggregate the page as a whole with C level builtins (map, sum, set)
+        # rather than updating every counter key by key
+        if len(keys) > 0:
+            sizes = list(map(getSize, keys))
+            storageClasses = list(map(getStorageClass, keys))
+            pageSize = sum(sizes)
+            pageLastModified = int(max(map(getLastModified, keys)).timestamp())
+
+            numberOfFiles += len(keys)
+            sizeOfFiles += pageSize
+
+            # Pages mostly hold a single storage class, and only a few
+            # otherwise: sum each class in a C level pass over the page
+            pageClasses = set(storageClasses)
+            if len(pageClasses) == 1:
+                classCounts[storageClasses[0]] += len(keys)
+                classSizes[storageClasses[0]] += pageSize
+            else:
+                classCounts.update(storageClasses)
+                for storageClass in pageClasses:
+                    classSizes[storageClass] += sum(compress(sizes, map(eq, storageClasses, repeat(storageClass))))
+
+            if pageLastModified > lastModified:
+                lastModified = pageLastModified
+
+        if rangeDone:
+            break
+
+    # Listings don't report the server side encryption of keys
+    encryptedCounts = Counter({ None: numberOfFiles }) if numberOfFiles > 0 else Counter()
+    encryptedSizes = Counter({ None: sizeOfFiles })
+
+    return {
+        "numberOfFiles" : numberOfFiles,
+        "sizeOfFiles"   : sizeOfFiles,
+        "modifiedDate"  : datetime.fromtimestamp(lastModified, timezone.utc).isoformat() if lastModified > 0 else "",
+        "storageClasses": TotalsToDict(classCounts, classSizes),
+        "encrypted"     : TotalsToDict(encryptedCounts, encryptedSizes),
+    }
+
+
+def ShardBoundaries(prefix, shards):
+    """Split the key space under a prefix into contiguous ranges.
+
+    Args:
+        prefix (string): The prefix all the keys share.
+        shards (int): The number of ranges to split the key space into.
+
+    Returns:
+        list: The shards - 1 keys bounding the ranges, in increasing order.
     """
-    return bucket.list_versions if versions else bucket.list
+    width = 1
+    while len(SHARD_CHARS) ** width < shards:
+        width += 1
+
+    space = [ "".join(p) for p in product(SHARD_CHARS, repeat = width) ]
+    return [ prefix + space[i * len(space) // shards] for i in range(1, shards) ]
 
 
 @LogCalls
-def Stats(bucket, args):
+def ShardedListingStats(s3, bucketName, args, keyMatcher = None):
+    """Calculate the key statistics of a bucket by listing key ranges in parallel.
+
+    Each range is listed by ListingStats() in a thread and the partial
+    statistics are merged once all the ranges are done. Since the ranges are
+    contiguous every key is counted regardless of how the keys are named.
+
+    Args:
+        s3 (botocore.client.S3): The s3 client to issue requests with.
+        bucketName (string): The name of the bucket to list.
+        args (dict): The result of command-line arguments parsing.
+        keyMatcher (callable): The Matcher() keys must satisfy to be counted,
+            None to count every key.
+
+    Returns:
+        dict: The same statistics as ListingStats().
+    """
+    boundaries = ShardBoundaries(args.prefix, args.shards)
+    keyRanges = list(zip([ None ] + boundaries, boundaries + [ None ]))
+
+    pool = ThreadPool(min(args.threads, len(keyRanges)))
+    shards = pool.map(lambda keyRange: ListingStats(s3, bucketName, args, keyMatcher, keyRange),
+                      keyRanges, chunksize = 1)
+    pool.close()
+    pool.join()
+
+    stats = shards[0]
+    for shard in shards[1:]:
+        stats["numberOfFiles"] += shard["numberOfFiles"]
+        stats["sizeOfFiles"] += shard["sizeOfFiles"]
+        stats["modifiedDate"] = max(stats["modifiedDate"], shard["modifiedDate"])
+
+        for field in ("storageClasses", "encrypted"):
+            for name, counters in shard[field].items():
+                stats[field][name]["numberOfFiles"] += counters["numberOfFiles"]
+                stats[field][name]["sizeOfFiles"] += counters["sizeOfFiles"]
+
+    return stats
+
+
+@LogCalls
+def InventoryManifest(s3, bucketName, args):
+    """Fetch the manifest of the latest parquet S3 Inventory of a bucket.
+
+    Args:
+        s3 (botocore.client.S3): The s3 client to issue requests with.
+        bucketName (string): The name of the inventoried bucket.
+        args (dict): The result of command-line arguments parsing.
+
+    Returns:
+        tuple: The name of the bucket holding the inventory and the parsed
+            manifest.json, or (None, None) when the bucket has no enabled
+            parquet inventory reporting the size of all the keys covered by
+            --prefix and --sum-prev-versions.
+    """
+    try:
+        configs = s3.list_bucket_inventory_configurations(Bucket = bucketName)
+    except ClientError as e:
+        info("[{}] can't get the inventory configurations: {}".format(bucketName, e))
+        return None, None
+
+    for config in configs.get("InventoryConfigurationList", []):
+        destination = config["Destination"]["S3BucketDestination"]
+        if not config["IsEnabled"] or destination["Format"] != "Parquet":
+            continue
+
+        # Size is an optional field of the inventories
+        if "Size" not in config.get("OptionalFields", []):
+            continue
+
+        # The inventory must cover every key of --prefix, and their previous
+        # versions with --sum-prev-versions
+        if not args.prefix.startswith(config.get("Filter", {}).get("Prefix", "")):
+            continue
+        if args.sumPrevVersions and config["IncludedObjectVersions"] != "All":
+            continue
+
+        # Inventories are delivered under
+        # [prefix/]sourceBucket/configId/YYYY-MM-DDTHH-MMZ/manifest.json
+        inventoryBucket = destination["Bucket"].split(":::")[-1]
+        inventoryPrefix = "/".join([ p for p in (destination.get("Prefix"), bucketName, config["Id"]) if p ]) + "/"
+
+        # The inventory bucket may belong to another account
+        try:
+            deliveries = s3.get_paginator("list_objects_v2").paginate(Bucket = inventoryBucket,
+                                                                      Prefix = inventoryPrefix,
+                                                                      Delimiter = "/")
+            deliveries = [ d["Prefix"] for page in deliveries for d in page.get("CommonPrefixes", [])
+                           if INVENTORY_DELIVERY.match(d["Prefix"][len(inventoryPrefix):]) ]
+            if not deliveries:
+                continue
+
+            manifest = s3.get_object(Bucket = inventoryBucket, Key = max(deliveries) + "manifest.json")
+        except ClientError as e:
+            info("[{}] can't read the {} inventory: {}".format(bucketName, config["Id"], e))
+            continue
+
+        return inventoryBucket, json.loads(manifest["Body"].read())
+
+    return None, None
+
+
+@LogCalls
+def InventoryStats(s3, bucketName, args, keyMatcher = None):
+    """Calculate the key statistics of a bucket from its latest S3 Inventory.
+
+    The parquet files of the inventory are aggregated with the pyarrow compute
+    kernels instead of listing every key of the bucket.
+
+    Args:
+        s3 (botocore.client.S3): The s3 client to issue requests with.
+        bucketName (string): The name of the inventoried bucket.
+        args (dict): The result of command-line arguments parsing.
+        keyMatcher (callable): The Matcher() keys must satisfy to be counted,
+            None to count every key.
+
+    Returns:
+        dict: The same statistics as ListingStats(), or None when the bucket
+            has no usable inventory.
+    """
+    inventoryBucket, manifest = InventoryManifest(s3, bucketName, args)
+    if manifest is None:
+        return None
+
+    lastModified = None
+
+    stats = {
+        "numberOfFiles" : 0,
+        "sizeOfFiles"   : 0,
+        "modifiedDate"  : "",
+        "storageClasses": defaultdict(lambda: defaultdict(int)),
+        "encrypted"     : defaultdict(lambda: defaultdict(int)),
+    }
+
+    for inventoryFile in manifest["files"]:
+        body = s3.get_object(Bucket = inventoryBucket, Key = inventoryFile["key"])["Body"].read()
+        parquetFile = pq.ParquetFile(pa.BufferReader(body))
+        columns = [ c for c in INVENTORY_COLUMNS if c in parquetFile.schema_arrow.names ]
+        table = parquetFile.read(columns = columns)
+
+        if "is_delete_marker" in columns:
+            table = table.filter(pc.invert(pc.fill_null(table["is_delete_marker"], False)))
+        if "is_latest" in columns and not args.sumPrevVersions:
+            table = table.filter(pc.fill_null(table["is_latest"], True))
+        if args.prefix:
+            table = table.filter(pc.starts_with(table["key"], args.prefix))
+        if keyMatcher is not None:
+            table = table.filter(pa.array([ keyMatcher(k) is not None for k in table["key"].to_pylist() ],
+                                          type = pa.bool_()))
+
+        if table.num_rows == 0:
+            continue
+
+        fileSize = pc.sum(table["size"]).as_py() or 0
+
+        stats["numberOfFiles"] += table.num_rows
+        stats["sizeOfFiles"] += fileSize
+
+        for column, target in (("storage_class", stats["storageClasses"]),
+                               ("encryption_status", stats["encrypted"])):
+            if column not in columns:
+                target[None]["numberOfFiles"] += table.num_rows
+                target[None]["sizeOfFiles"] += fileSize
+                continue
+
+            groups = table.group_by(column).aggregate([ ("key", "count"), ("size", "sum") ])
+            for group in groups.to_pylist():
+                target[group[column]]["numberOfFiles"] += group["key_count"]
+                target[group[column]]["sizeOfFiles"] += group["size_sum"] or 0
+
+        if "last_modified_date" in columns:
+            fileLastModified = pc.max(table["last_modified_date"]).as_py()
+            if lastModified is None or fileLastModified > lastModified:
+                lastModified = fileLastModified
+
+    if lastModified is not None:
+        stats["modifiedDate"] = lastModified.isoformat()
+
+    return stats
+
+
+@LogCalls
+def CloudWatchStats(session, s3, buckets, threads = 8):
+    """Fetch the size and number of files of buckets from their daily S3
+    storage metrics in CloudWatch.
+
+    The metrics of every bucket of a region are listed and fetched together,
+    up to CLOUDWATCH_MAX_QUERIES per GetMetricData request.
+
+    Args:
+        session (boto3.session.Session): The session to create the regional
+            CloudWatch clients from.
+        s3 (botocore.client.S3): The s3 client to locate the buckets with.
+        buckets (list): A list of buckets, as returned by list_buckets.
+        threads (int): The number of threads locating the buckets.
+
+    Returns:
+        dict: The same statistics as ListingStats(), by bucket name, for the
+            buckets having metrics. The storage classes and the encryption
+            state have no number of files.
+    """
+    pool = ThreadPool(threads)
+    locations = pool.map(lambda b: s3.get_bucket_location(Bucket = b["Name"])["LocationConstraint"],
+                         buckets, chunksize = 1)
+    pool.close()
+    pool.join()
+
+    regions = defaultdict(set)
+    for bucket, location in zip(buckets, locations):
+        # us-east-1 has no location constraint, EU is the legacy eu-west-1
+        regions[{ None: "us-east-1", "": "us-east-1", "EU": "eu-west-1" }.get(location, location)].add(bucket["Name"])
+
+    endTime = datetime.now(timezone.utc)
+    startTime = endTime - timedelta(days = 3)
+    stats = {}
+
+    for region, bucketNames in regions.items():
+        cloudWatch = session.client("cloudwatch", region_name = region)
+
+        metrics = []
+        for metricName in ("BucketSizeBytes", "NumberOfObjects"):
+            for page in cloudWatch.get_paginator("list_metrics").paginate(Namespace = "AWS/S3",
+                                                                          MetricName = metricName):
+                metrics += [ m for m in page["Metrics"]
+                             if any(d["Name"] == "BucketName" and d["Value"] in bucketNames for d in m["Dimensions"])
+                             # The *Overhead storage types are billed bytes
+                             # besides the objects, not object bytes
+                             and not any(d["Name"] == "StorageType" and d["Value"].endswith("Overhead")
+                                         for d in m["Dimensions"]) ]
+
+        for offset in range(0, len(metrics), CLOUDWATCH_MAX_QUERIES):
+            batch = metrics[offset:offset + CLOUDWATCH_MAX_QUERIES]
+            queries = [ { "Id"        : "m{}".format(i),
+                          "MetricStat": { "Metric": m, "Period": 86400, "Stat": "Average" } }
+                        for i, m in enumerate(batch) ]
+
+            seen = set()
+            pages = cloudWatch.get_paginator("get_metric_data").paginate(MetricDataQueries = queries,
+                                                                         StartTime = startTime,
+                                                                         EndTime = endTime)
+            for page in pages:
+                for data in page["MetricDataResults"]:
+                    # Values come latest first, a query may span pages
+                    if not data["Values"] or data["Id"] in seen:
+                        continue
+                    seen.add(data["Id"])
+
+                    metric = batch[int(data["Id"][1:])]
+                    dimensions = dict([ (d["Name"], d["Value"]) for d in metric["Dimensions"] ])
+                    value = int(data["Values"][0])
+
+                    bucketStats = stats.setdefault(dimensions["BucketName"], {
+                        "numberOfFiles" : 0,
+                        "sizeOfFiles"   : 0,
+                        "modifiedDate"  : "",
+                        "storageClasses": {},
+                        "encrypted"     : {},
+                    })
+
+                    if metric["MetricName"] == "NumberOfObjects":
+                        bucketStats["numberOfFiles"] += value
+                        continue
+
+                    storageType = dimensions["StorageType"]
+                    storageClass = CLOUDWATCH_STORAGE_CLASSES.get(storageType, storageType)
+                    bucketStats["sizeOfFiles"] += value
+                    bucketStats["storageClasses"].setdefault(storageClass, { "numberOfFiles": None,
+                                                                            "sizeOfFiles"  : 0 })
+                    bucketStats["storageClasses"][storageClass]["sizeOfFiles"] += value
+
+    return stats
+
+
+@LogCalls
+def CacheConnect(cachePath):
+    """Open the stats cache database, creating it if needed.
+
+    Args:
+        cachePath (string): The path of the sqlite cache database.
+
+    Returns:
+        sqlite3.Connection: The connection to the cache database.
+    """
+    cachePath = path.expanduser(cachePath)
+    if path.dirname(cachePath):
+        makedirs(path.dirname(cachePath), exist_ok = True)
+
+    db = sqlite3.connect(cachePath, timeout = 30)
+    db.execute("CREATE TABLE IF NOT EXISTS stats ("
+               "  bucket  TEXT NOT NULL,"
+               "  options TEXT NOT NULL,"
+               "  mtime   REAL NOT NULL,"
+               "  json    TEXT NOT NULL,"
+               "  PRIMARY KEY (bucket, options))")
+    return db
+
+
+def RestoreNoneKey(items):
+    """Turn back the "null" key json made out of a None key into None.
+
+    Args:
+        items (dict): A dictionary loaded from json.
+
+    Returns:
+        dict: The dictionary with its "null" key, if any, as None.
+    """
+    return dict([ (None if k == "null" else k, v) for k, v in items.items() ])
+
+
+@LogCalls
+def CacheGet(bucketName, args):
+    """Fetch the cached Stats() of a bucket.
+
+    Args:
+        bucketName (string): The name of the bucket.
+        args (dict): The result of command-line arguments parsing.
+
+    Returns:
+        dict: The cached statistics of the bucket, or None when there are
+            none younger than --cache-ttl seconds.
+    """
+    options = json.dumps([ getattr(args, a) for a in CACHE_ARGS ])
+
+    with closing(CacheConnect(args.cache)) as db:
+        row = db.execute("SELECT json FROM stats WHERE bucket = ? AND options = ? AND mtime > ?",
+                         (bucketName, options, time.time() - args.cacheTtl)).fetchone()
+
+    if not row:
+        return None
+
+    # json turned the None keys (no encryption state or storage class, rule
+    # without an ID) into "null", restore them so they match fresh results
+    result = json.loads(row[0])
+    for field in CACHE_NONE_KEYS:
+        if field in result:
+            result[field] = RestoreNoneKey(result[field])
+
+    return result
+
+
+@LogCalls
+def CachePut(bucketName, args, result):
+    """Store the Stats() of a bucket in the cache.
+
+    Args:
+        bucketName (string): The name of the bucket.
+        args (dict): The result of command-line arguments parsing.
+        result (dict): The statistics of the bucket.
+    """
+    options = json.dumps([ getattr(args, a) for a in CACHE_ARGS ])
+
+    with closing(CacheConnect(args.cache)) as db:
+        with db:
+            db.execute("INSERT OR REPLACE INTO stats (bucket, options, mtime, json) VALUES (?, ?, ?, ?)",
+                       (bucketName, options, time.time(), json.dumps(result)))
+
+
+@LogCalls
+def BucketDetails(s3, bucketName):
+    """Fetch the lifecycle, location, logging, tags and versioning of a bucket.
+
+    The five requests are issued concurrently, costing a single round-trip.
+
+    Args:
+        s3 (botocore.client.S3): The s3 client to issue requests with.
+        bucketName (string): The name of the bucket.
+
+    Returns:
+        dict: The lifecycle (when configured), location, logging, tags and
+            version details of the bucket.
+    """
+    details = {}
+
+    pool = ThreadPool(len(BUCKET_DETAILS))
+    calls = dict([ (name, pool.apply_async(getattr(s3, method), kwds = { "Bucket": bucketName }))
+                   for name, method in BUCKET_DETAILS ])
+    pool.close()
+
+    try:
+        rules = calls["lifecycle"].get()["Rules"]
+        details["lifecycle"] = dict([ (lc.get("ID"), LifecycleToDict(lc)) for lc in rules ])
+    except ClientError:
+        pass
+
+    details["location"] = calls["location"].get()["LocationConstraint"]
+    if not details["location"]:
+        details["location"] = "DEFAULT"
+
+    details["logging"]  = LoggingStatusToDict(calls["logging"].get())
+
+    try:
+        tagSet = calls["tags"].get()["TagSet"]
+    except ClientError:
+        tagSet = []
+    details["tags"]     = dict([ (t["Key"], t["Value"]) for t in tagSet ])
+
+    versioning = calls["version"].get()
+    versioning.pop("ResponseMetadata", None)
+    details["version"]  = versioning
+
+    pool.join()
+    return details
+
+
+@LogCalls
+def Stats(bucket, s3, args, keyMatcher = None, metrics = None):
     """Calculate the statistics of a given bucket based on command-line args.
 
     Args:
-        bucket (boto.s3.bucket): The bucket object to gather stats for.
+        bucket (dict): The bucket, as returned by list_buckets, to gather
+            stats for.
+        s3 (botocore.client.S3): The s3 client to issue requests with.
         args (dict): The result of command-line arguments parsing.
+        keyMatcher (callable): The Matcher() keys must satisfy to be counted,
+            None to count every key.
+        metrics (dict): The CloudWatchStats() of the buckets, None to
+            gather the stats from the keys of the bucket.
 
     Returns:
         dict: A dictionary representation of the statistics for a given bucket.
     """
     execTime = time.time()
 
+    bucketName = bucket["Name"]
+
+    details = None
+    if args.bucketDetails:
+        details = BucketDetails(s3, bucketName)
+
+    # Versioned buckets bypass the cache, their versions keep changing
+    # without the bucket's keys doing so, as do the buckets whose versioning
+    # can't be checked
+    useCache = False
+    if args.cache and details is not None:
+        useCache = details["version"].get("Status") != "Enabled"
+    elif args.cache:
+        try:
+            useCache = s3.get_bucket_versioning(Bucket = bucketName).get("Status") != "Enabled"
+        except ClientError as e:
+            info("[{}] can't get the versioning, not caching: {}".format(bucketName, e))
+
+    if useCache:
+        result = CacheGet(bucketName, args)
+        if result is not None:
+            if details is not None:
+                result.update(details)
+            info("[{}] loaded from the cache".format(bucketName))
+            return result
+
+    # The keys are laid out in their json output order, the stats and the
+    # bucket details fill them in or come after them
     result = {
-        "name"          : bucket.name,
-        "creationDate"  : bucket.creation_date,
+        "name"          : bucketName,
+        "creationDate"  : bucket["CreationDate"].isoformat(),
         "numberOfFiles" : 0,
         "sizeOfFiles"   : 0,
         "modifiedDate"  : "",
@@ -150,73 +803,139 @@ def Stats(bucket, args):
         "encrypted"     : defaultdict(lambda: defaultdict(int)),
     }
 
-    if args.bucketDetails:
-        try:
-            result["lifecycle"] = dict([ (lc.id, LifecycleToDict(lc)) for lc in bucket.get_lifecycle_config() ])
-        except:
-            pass
-
-        result["location"] = bucket.get_location()
-        if result["location"] == "":
-            result["location"] = "DEFAULT"
+    if details is not None:
+        result.update(details)
 
-        result["logging"]  = LoggingStatusToDict(bucket.get_logging_status())
-        result["tags"]     = dict([ (t.key, t.value) for t in bucket.get_tags()[0] ])
-        result["version"]  = bucket.get_versioning_status()
+    stats = None
+    if metrics is not None:
+        stats = metrics.get(bucketName)
+        if stats is None:
+            warn("[{}] no CloudWatch storage metrics found, listing the bucket".format(bucketName))
 
-    for key in Lister(bucket, args.sumPrevVersions)(prefix = args.prefix):
-        if len(ApplyFilters(args.filter, [key], args.filterRe)) > 0:
+    if stats is None and args.useInventory:
+        stats = InventoryStats(s3, bucketName, args, keyMatcher)
+        if stats is None:
+            warn("[{}] no usable parquet inventory found, listing the bucket".format(bucketName))
 
-            result["numberOfFiles"] += 1
-            result["sizeOfFiles"] += key.size
+    if stats is None and args.shards > 1:
+        stats = ShardedListingStats(s3, bucketName, args, keyMatcher)
+    elif stats is None:
+        stats = ListingStats(s3, bucketName, args, keyMatcher)
 
-            result["storageClasses"][key.storage_class]["numberOfFiles"] += 1
-            result["storageClasses"][key.storage_class]["sizeOfFiles"] += key.size
+    result.update(stats)
 
-            result["encrypted"][key.encrypted]["numberOfFiles"] += 1
-            result["encrypted"][key.encrypted]["sizeOfFiles"] += key.size
+    if useCache:
+        CachePut(bucketName, args, result)
 
-            if key.last_modified > result["modifiedDate"]:
-                result["modifiedDate"] = key.last_modified
-
-    info("[{}] listed in {} seconds".format(bucket.name, time.time() - execTime))
+    info("[{}] listed in {} seconds".format(bucketName, time.time() - execTime))
     return result
 
 
 @LogCalls
-def ParallelStats(buckets, threads=8):
+def ParallelStats(s3, buckets, threads=8, keyMatcher=None, metrics=None):
     """A util function that requests the bucket Stats in parallel.
 
     Args:
-        buckets (list): A list of string, one item per bucket.
+        s3 (botocore.client.S3): The s3 client shared by the threads.
+        buckets (list): A list of buckets, as returned by list_buckets.
         threads (int): The number of threads in the ThreadPool.
+        keyMatcher (callable): The Matcher() used to filter keys.
+        metrics (dict): The CloudWatchStats() of the buckets, if any.
 
-    Returns:
-        list: A list of dictionary based on the result of Stats().
+    Yields:
+        dict: The result of Stats() for each bucket, as soon as it completes.
     """
     pool = ThreadPool(threads)
-    results = pool.map(partial(Stats, args=args), buckets)
-    pool.close()
-    pool.join()
-    return results
+    try:
+        # Hand out one bucket at a time, a large bucket must not hold back the
+        # smaller ones that would otherwise be batched in the same chunk
+        for result in pool.imap_unordered(partial(Stats, s3=s3, args=args, keyMatcher=keyMatcher, metrics=metrics),
+                                          buckets, chunksize = 1):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
 
 
-@LogCalls
-def ApplyFilters(pattern, items, regex):
+def Matcher(pattern, regex):
+    """Compile a glob or regex pattern into a match function.
+
+    Args:
+        pattern (string): The pattern to compile, glob or regex.
+        regex (bool): True the pattern is a regex, False it is a glob.
+
+    Returns:
+        callable: The match method of the compiled pattern, or None when the
+            pattern is the match-all "*" glob.
+    """
+    if regex:
+        return re.compile(pattern).match
+
+    if pattern == "*":
+        return None
+
+    return re.compile(translate(pattern)).match
+
+
+def HumanSize(bytes):
+    """Format a number of bytes in a human readable way (e.g., 1K 234M 2G).
+
+    Args:
+        bytes (int): The number of bytes.
+
+    Returns:
+        string: The number of bytes, rounded down to the largest unit it holds.
+    """
+    unit = min(max(bytes.bit_length() - 1, 0) // 10, len(SIZE_UNITS) - 1)
+    return "{}{}".format(bytes >> (10 * unit), SIZE_UNITS[unit])
+
+
+def ApplyFilters(pattern, items, regex, field = "Name"):
     """Filter a given list based on a glob or regex pattern.
 
     Args:
         pattern (string): The pattern on which to filter, glob or regex.
-        items (list): List of string to filter.
+        items (list): List of dictionaries to filter.
         regex (bool): True the pattern is a regex, False it is a glob.
+        field (string): The item field the pattern is matched against.
 
     Returns:
         list: The filtered list of items.
     """
-    if regex:
-        return [ b for b in items if re.match(pattern, b.name) ]
+    matcher = Matcher(pattern, regex)
+    if matcher is None:
+        return items
+
+    return [ b for b in items if matcher(b[field]) ]
+
+
+@LogCalls
+def PrintJsonResults(results):
+    """Prints the results as a json array, writing each one as it comes.
+
+    Args:
+        results (iterable): The dictionaries representing the result of
+            Stats() for each bucket.
+    """
+    # The results are built in a fixed key order, there's no need to sort
+    if orjson is not None:
+        options = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+        dumps = partial(orjson.dumps, option = options)
+    else:
+        dumps = lambda r: json.dumps(r, indent = 2, ensure_ascii = False).encode("utf-8")
+
+    out = sys.stdout.buffer
+
+    separator = b"\n  "
+    out.write(b"[")
+
+    for result in results:
+        out.write(separator)
+        out.write(dumps(result).replace(b"\n", b"\n  "))
+        out.flush()
+        separator = b",\n  "
 
-    return [ b for b in items if fnmatch(b.name, pattern) ]
+    out.write(b"]\n" if separator == b"\n  " else b"\n]\n")
 
 
 @LogCalls
@@ -229,31 +948,32 @@ def PrintResults(args, results):
             Stats() for each bucket.
     """
     # Sum for the total row
-    numberOfFiles = sum([ r["numberOfFiles"] for r in results ])
-    sizeOfFiles = sum([ r["sizeOfFiles"] for r in results ])
+    numberOfFiles = sum(r["numberOfFiles"] for r in results)
+    sizeOfFiles = sum(r["sizeOfFiles"] for r in results)
 
     if args.byRegion:
-        regions = set([ r["location"] for r in results ])
+        regions = defaultdict(lambda: [0, 0])
+        for r in results:
+            region = regions[r["location"]]
+            region[0] += r["numberOfFiles"]
+            region[1] += r["sizeOfFiles"]
 
         t = PrettyTable(["region", "numberOfFiles", "sizeOfFiles", "% size"])
 
         t.align["region"] , = "l"
         t.align["numberOfFiles"], t.align["sizeOfFiles"], t.align["% size"] = "r", "r", "r"
 
-        for region in regions:
-            regionNumberOfFiles = sum([ r["numberOfFiles"] for r in results if r["location"] == region ])
-            regionSizeOfFiles = sum([ r["sizeOfFiles"] for r in results if r["location"] == region ])
-            
+        for region, (regionNumberOfFiles, regionSizeOfFiles) in regions.items():
             t.add_row([ region,
                         regionNumberOfFiles,
-                        size(regionSizeOfFiles) if args.human else regionSizeOfFiles,
+                        HumanSize(regionSizeOfFiles) if args.human else regionSizeOfFiles,
                         "{:,.2f}%".format(float(regionSizeOfFiles) / float(sizeOfFiles) * 100) ])
 
         t.add_row([ "Total",
                     numberOfFiles,
-                    size(sizeOfFiles) if args.human else sizeOfFiles,
+                    HumanSize(sizeOfFiles) if args.human else sizeOfFiles,
                     "100.00%" ])
-        print t
+        print(t)
 
     elif args.byStorageType:
         t = PrettyTable(["region", "bucketName", "storageClass",
@@ -263,21 +983,21 @@ def PrintResults(args, results):
         t.align["numberOfFiles"], t.align["sizeOfFiles"], t.align["% size"] = "r", "r", "r"
 
         for result in results:
-            for storClass in result["storageClasses"]:
+            for storClass, stats in result["storageClasses"].items():
                 t.add_row([ result["location"],
                             result["name"],
                             storClass,
-                            result["numberOfFiles"],
-                            size(result["sizeOfFiles"]) if args.human else result["sizeOfFiles"],
-                            "{:,.2f}%".format(float(result["sizeOfFiles"]) / float(sizeOfFiles) * 100) ])
+                            stats["numberOfFiles"],
+                            HumanSize(stats["sizeOfFiles"]) if args.human else stats["sizeOfFiles"],
+                            "{:,.2f}%".format(float(stats["sizeOfFiles"]) / float(sizeOfFiles) * 100) ])
 
         t.add_row([ "Total",
                     "",
                     "",
                     numberOfFiles,
-                    size(sizeOfFiles) if args.human else sizeOfFiles,
+                    HumanSize(sizeOfFiles) if args.human else sizeOfFiles,
                     "100.00%" ])
-        print t
+        print(t)
 
     elif args.byEncryption:
         t = PrettyTable(["region", "bucketName", "encryption",
@@ -287,21 +1007,21 @@ def PrintResults(args, results):
         t.align["numberOfFiles"], t.align["sizeOfFiles"], t.align["% size"] = "r", "r", "r"
 
         for result in results:
-            for enc in result["encrypted"]:
+            for enc, stats in result["encrypted"].items():
                 t.add_row([ result["location"],
                             result["name"],
                             enc,
-                            result["numberOfFiles"],
-                            size(result["sizeOfFiles"]) if args.human else result["sizeOfFiles"],
-                            "{:,.2f}%".format(float(result["sizeOfFiles"]) / float(sizeOfFiles) * 100) ])
+                            stats["numberOfFiles"],
+                            HumanSize(stats["sizeOfFiles"]) if args.human else stats["sizeOfFiles"],
+                            "{:,.2f}%".format(float(stats["sizeOfFiles"]) / float(sizeOfFiles) * 100) ])
 
         t.add_row([ "Total",
                     "",
                     "",
                     numberOfFiles,
-                    size(sizeOfFiles) if args.human else sizeOfFiles,
+                    HumanSize(sizeOfFiles) if args.human else sizeOfFiles,
                     "100.00%" ])
-        print t
+        print(t)
 
     else:
         t = PrettyTable(["region", "bucketName", "numberOfFiles", "sizeOfFiles", "% size"])
@@ -313,15 +1033,15 @@ def PrintResults(args, results):
             t.add_row([ result["location"],
                         result["name"],
                         result["numberOfFiles"],
-                        size(result["sizeOfFiles"]) if args.human else result["sizeOfFiles"],
+                        HumanSize(result["sizeOfFiles"]) if args.human else result["sizeOfFiles"],
                         "{:,.2f}%".format(float(result["sizeOfFiles"]) / float(sizeOfFiles) * 100) ])
 
         t.add_row([ "Total",
                     "",
                     numberOfFiles,
-                    size(sizeOfFiles) if args.human else sizeOfFiles,
+                    HumanSize(sizeOfFiles) if args.human else sizeOfFiles,
                     "100.00%" ])
-        print t
+        print(t)
 
 
 #############
@@ -334,24 +1054,55 @@ def Main(args):
     Args:
         args (dict): The result of the command-line argument parsing.
     """
-    global debug, info, warn, error
+    global log, debug, info, warn, error
 
     s3statsLogging = Logging()
     s3statsLogging.Configure(args)
 
+    log = s3statsLogging.log
     debug, info, warn, error = s3statsLogging.GetLoggers()
 
+    if args.useInventory and pa is None:
+        error("--use-inventory requires the pyarrow package")
+        sys.exit(1)
+
+    if args.fromCloudWatch and (args.prefix or args.filter != "*" or args.filterRe):
+        error("--from-cloudwatch only reports whole buckets, it can't be used"
+              " with --prefix or --filter")
+        sys.exit(1)
+
     if args.verbose:
-        boto.set_stream_logger('boto')
+        boto3.set_stream_logger('botocore')
+
+    # A single client is shared by all the threads, its pool keeps one
+    # persistent connection per concurrent request: each bucket thread lists
+    # up to --threads key ranges concurrently, after fetching its details
+    # concurrently
+    bucketConnections = min(args.threads, max(args.shards, 1))
+    if args.bucketDetails:
+        bucketConnections = max(bucketConnections, len(BUCKET_DETAILS))
+    connections = args.threads * bucketConnections
 
-    s3 = boto.connect_s3(args.awsKeyId, args.awsSecret)
-    buckets = ApplyFilters(args.bucket, s3.get_all_buckets(), args.bucketRe)
-    results = ParallelStats(buckets, args.threads)
+    session = boto3.session.Session(aws_access_key_id     = args.awsKeyId,
+                                    aws_secret_access_key = args.awsSecret)
+    s3 = session.client("s3",
+                        config = Config(max_pool_connections = connections,
+                                        tcp_keepalive        = True,
+                                        retries              = { "max_attempts": 10,
+                                                                 "mode"        : "adaptive" }))
+    buckets = ApplyFilters(args.bucket, s3.list_buckets()["Buckets"], args.bucketRe)
+    keyMatcher = Matcher(args.filter, args.filterRe)
+
+    metrics = None
+    if args.fromCloudWatch:
+        metrics = CloudWatchStats(session, s3, buckets, args.threads)
+
+    results = ParallelStats(s3, buckets, args.threads, keyMatcher, metrics)
 
     if args.format == "json":
-        print json.dumps(results, sort_keys = True, indent = 4)
+        PrintJsonResults(results)
     else:
-        PrintResults(args, results)
+        PrintResults(args, sorted(results, key = itemgetter("name")))
 
 
 #############
@@ -364,7 +1115,7 @@ if __name__ == "__main__":
     argParser = ArgumentParser(prog = path.basename(__file__))
 
     # Ways to specify credentials:
-    # http://boto.cloudhackers.com/en/latest/boto_config_tut.html
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/credentials.html
     argParser.add_argument("--awsKeyId",
                            dest    = "awsKeyId",
                            action  = "store",
@@ -386,6 +1137,15 @@ if __name__ == "__main__":
                            default = 8,
                            help    = "The number of threads to use in"
                                      " multithreaded operations.")
+    argParser.add_argument("--shards",
+                           dest    = "shards",
+                           action  = "store",
+                           type    = int,
+                           default = 1,
+                           help    = "The number of key ranges each bucket is"
+                                     " split into, the ranges are listed in"
+                                     " parallel using up to --threads threads"
+                                     " per bucket.")
     argParser.add_argument("--debug",
                            dest    = "debug",
                            action  = "store_true",
@@ -454,6 +1214,41 @@ if __name__ == "__main__":
                            action  = "store_true",
                            help    = "Use all versions of a file in size and"
                                      "file count calculations.")
+    argParser.add_argument("--use-inventory",
+                           dest    = "useInventory",
+                           action  = "store_true",
+                           help    = "Aggregate the latest parquet S3 Inventory"
+                                     " of the buckets instead of listing their"
+                                     " keys, buckets without one are listed."
+                                     " Requires pyarrow.")
+    argParser.add_argument("--from-cloudwatch",
+                           dest    = "fromCloudWatch",
+                           action  = "store_true",
+                           help    = "Read the size and number of files of the"
+                                     " buckets from their daily CloudWatch"
+                                     " storage metrics instead of listing their"
+                                     " keys, buckets without metrics are"
+                                     " listed. The metrics include all versions,"
+                                     " the billing overhead storage types"
+                                     " (e.g., GlacierObjectOverhead) are left"
+                                     " out, and they have no modification date,"
+                                     " encryption state or number of files per"
+                                     " storage class.")
+    argParser.add_argument("--cache",
+                           dest    = "cache",
+                           action  = "store",
+                           default = None,
+                           help    = "The path of a sqlite database (e.g.,"
+                                     " ~/.cache/s3stats.sqlite) caching the"
+                                     " stats of each bucket, disabled by"
+                                     " default.")
+    argParser.add_argument("--cache-ttl",
+                           dest    = "cacheTtl",
+                           action  = "store",
+                           type    = int,
+                           default = 28800,
+                           help    = "Only when --cache is set. The number of"
+                                     " seconds cached stats are reused for.")
     argParser.add_argument("--bucket-details",
                            dest    = "bucketDetails",
                            action  = "store_true",